@@ -55,7 +55,7 @@ def main():
     
     # 4. 文档上传示例
     print("\n4. 文档上传管理器示例...")
-    upload_manager = DocumentUploadManager()
+    upload_manager = DocumentUploadManager(builder=builder)
     
     # 模拟上传文件
     print("创建测试文档...")
@@ -70,9 +70,9 @@ def main():
     if upload_result['success']:
         print(f"✓ {upload_result['message']}")
         
-        # 重新构建知识库
-        print("\n重新构建知识库（包含新文档）...")
-        result = builder.build_knowledge_base(rebuild=True)
+        # 上传时已增量添加到知识库
+        print("\n增量更新知识库（包含新文档）...")
+        result = upload_result['index_result']
         
         if result['success']:
             print(f"✓ {result['message']}")
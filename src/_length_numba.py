@@ -0,0 +1,47 @@
+"""
+中文加权长度计算的Numba实现
+
+与 ChineseSemanticSplitter._chinese_aware_length 的纯Python实现结果一致，
+numba 未安装时导入本模块会抛出 ImportError。
+"""
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True, nogil=True)
+def _is_space(cp):
+    """与 str.isspace 一致的空白字符判断"""
+    if 9 <= cp <= 13 or 28 <= cp <= 32:
+        return True
+    if cp < 0x85:
+        return False
+    return (cp == 0x85 or cp == 0xa0 or cp == 0x1680
+            or 0x2000 <= cp <= 0x200a
+            or cp == 0x2028 or cp == 0x2029 or cp == 0x202f
+            or cp == 0x205f or cp == 0x3000)
+
+
+@njit(cache=True, nogil=True)
+def _count(arr):
+    """统计码点数组的加权长度：中文与其他字符算1，英文字母每2个算1"""
+    chinese_chars = 0
+    english_chars = 0
+    other_chars = 0
+    for i in range(arr.size):
+        cp = arr[i]
+        if 0x4e00 <= cp <= 0x9fff:
+            chinese_chars += 1
+        elif 65 <= cp <= 90 or 97 <= cp <= 122:
+            english_chars += 1
+        elif not _is_space(cp):
+            other_chars += 1
+    return chinese_chars + other_chars + ((english_chars + 1) >> 1)
+
+
+def weighted_length(text: str) -> int:
+    """计算文本的中文加权长度"""
+    return int(_count(np.frombuffer(text.encode('utf-32-le', 'surrogatepass'), dtype=np.uint32)))
+
+
+# 导入时预热，提前完成JIT编译
+weighted_length("预热warmup")
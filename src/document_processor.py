@@ -1,10 +1,17 @@
 import os
 import re
-from typing import List, Optional
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, Iterator, List, Optional, Tuple
 from langchain_community.document_loaders import PyPDFLoader, TextLoader, UnstructuredWordDocumentLoader
 
 from utils.config import config
 
+# 文本清理使用的正则，模块加载时预编译
+_CTRL_RE = re.compile(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]')
+_WS_RE = re.compile(r'\s+')
+_CJK_PUNCT_RE = re.compile(r'\s*([，。；：！？])\s*')
+
 class DocumentProcessor:
     """文档处理器，统一管理不同格式的文档加载"""
     
@@ -21,60 +28,94 @@ class DocumentProcessor:
         Returns:
             List: 文档对象列表
         """
-        ext = os.path.splitext(file_path)[1].lower()
-        
-        if ext not in self.supported_extensions:
-            raise ValueError(f"不支持的文件格式: {ext}")
+        return _load_document_worker(file_path, self.supported_extensions)
+    
+    def load_documents(self, file_paths: Iterable[str]) -> List[Tuple[str, List, Optional[Exception]]]:
+        """
+        使用进程池并行加载多个文档
         
-        try:
-            if ext == '.pdf':
-                documents = self._load_pdf(file_path)
-            elif ext == '.txt' or ext == '.md':
-                documents = self._load_text(file_path)
-            elif ext == '.docx':
-                documents = self._load_docx(file_path)
-            else:
-                raise ValueError(f"未实现 {ext} 文件的加载器")
+        Args:
+            file_paths: 文件路径列表
             
-            # 清理文本并添加元数据
-            for doc in documents:
-                doc.page_content = self._clean_chinese_text(doc.page_content)
-                if not hasattr(doc, 'metadata'):
-                    doc.metadata = {}
-                doc.metadata['source'] = os.path.basename(file_path)
-                doc.metadata['file_path'] = file_path
+        Returns:
+            List[Tuple]: 按输入顺序排列的 (文件路径, 文档列表, 异常) 三元组
+        """
+        return list(self.iter_documents(file_paths))
+    
+    def iter_documents(self, file_paths: Iterable[str]) -> Iterator[Tuple[str, List, Optional[Exception]]]:
+        """
+        使用进程池并行加载多个文档，按输入顺序逐个产出结果
+        
+        同时在途的文件数有上限，消费方处理较慢时不会把所有文档堆积在内存中。
+        
+        Args:
+            file_paths: 文件路径列表
             
-            return documents
+        Yields:
+            Tuple: (文件路径, 文档列表, 异常) 三元组
+        """
+        file_paths = list(file_paths)
+        if len(file_paths) <= 1:
+            for path in file_paths:
+                yield self._load_document_safe(path)
+            return
+        
+        max_workers = min(len(file_paths), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            pending = deque()
+            for path in file_paths:
+                pending.append((path, executor.submit(_load_document_worker, path, self.supported_extensions)))
+                if len(pending) >= max_workers * 2:
+                    yield self._collect_result(*pending.popleft())
             
+            while pending:
+                yield self._collect_result(*pending.popleft())
+    
+    @staticmethod
+    def _collect_result(file_path: str, future) -> Tuple[str, List, Optional[Exception]]:
+        """取出进程池任务结果，异常作为结果返回"""
+        try:
+            return file_path, future.result(), None
+        except Exception as e:
+            return file_path, [], e
+    
+    def _load_document_safe(self, file_path: str) -> Tuple[str, List, Optional[Exception]]:
+        """加载单个文档，异常作为结果返回"""
+        try:
+            return file_path, self.load_document(file_path), None
         except Exception as e:
-            raise DocumentLoadingError(f"加载文档失败: {str(e)}")
+            return file_path, [], e
     
-    def _load_pdf(self, file_path: str) -> List:
+    @staticmethod
+    def _load_pdf(file_path: str) -> List:
         """加载PDF文档"""
         loader = PyPDFLoader(file_path)
         return loader.load()
     
-    def _load_text(self, file_path: str) -> List:
+    @staticmethod
+    def _load_text(file_path: str) -> List:
         """加载文本文件"""
         loader = TextLoader(file_path, encoding='utf-8')
         return loader.load()
     
-    def _load_docx(self, file_path: str) -> List:
+    @staticmethod
+    def _load_docx(file_path: str) -> List:
         """加载Word文档"""
         loader = UnstructuredWordDocumentLoader(file_path)
         return loader.load()
     
-    def _clean_chinese_text(self, text: str) -> str:
+    @staticmethod
+    def _clean_chinese_text(text: str) -> str:
         """清理中文文本中的特殊字符和格式"""
         if not text:
             return ""
         
         # 移除不可见字符
-        text = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F]', '', text)
+        text = _CTRL_RE.sub('', text)
         # 合并多个空白字符
-        text = re.sub(r'\s+', ' ', text)
+        text = _WS_RE.sub(' ', text)
         # 处理中文标点与空格的组合
-        text = re.sub(r'\s*([，。；：！？])\s*', r'\1 ', text)
+        text = _CJK_PUNCT_RE.sub(r'\1 ', text)
         # 移除多余的空格
         text = text.strip()
         
@@ -84,21 +125,65 @@ class DocumentProcessor:
         """批量加载目录中的所有文档"""
         all_documents = []
         
-        for filename in os.listdir(directory):
-            file_path = os.path.join(directory, filename)
-            if os.path.isfile(file_path):
-                ext = os.path.splitext(filename)[1].lower()
-                if ext in self.supported_extensions:
-                    try:
-                        documents = self.load_document(file_path)
-                        all_documents.extend(documents)
-                        print(f"✓ 成功加载: {filename} ({len(documents)}个片段)")
-                    except Exception as e:
-                        print(f"✗ 加载失败: {filename} - {str(e)}")
+        file_paths = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    ext = os.path.splitext(entry.name)[1].lower()
+                    if ext in self.supported_extensions:
+                        file_paths.append(entry.path)
+        
+        for file_path, documents, error in self.load_documents(file_paths):
+            filename = os.path.basename(file_path)
+            if error is None:
+                all_documents.extend(documents)
+                print(f"✓ 成功加载: {filename} ({len(documents)}个片段)")
+            else:
+                print(f"✗ 加载失败: {filename} - {str(error)}")
         
         return all_documents
 
 
+def _load_document_worker(file_path: str, supported_extensions) -> List:
+    """
+    加载并清理单个文档（模块级函数，可被进程池序列化）
+    
+    Args:
+        file_path: 文件路径
+        supported_extensions: 支持的扩展名集合
+        
+    Returns:
+        List: 文档对象列表
+    """
+    ext = os.path.splitext(file_path)[1].lower()
+    
+    if ext not in supported_extensions:
+        raise ValueError(f"不支持的文件格式: {ext}")
+    
+    try:
+        if ext == '.pdf':
+            documents = DocumentProcessor._load_pdf(file_path)
+        elif ext == '.txt' or ext == '.md':
+            documents = DocumentProcessor._load_text(file_path)
+        elif ext == '.docx':
+            documents = DocumentProcessor._load_docx(file_path)
+        else:
+            raise ValueError(f"未实现 {ext} 文件的加载器")
+        
+        # 清理文本并添加元数据
+        for doc in documents:
+            doc.page_content = DocumentProcessor._clean_chinese_text(doc.page_content)
+            if not hasattr(doc, 'metadata'):
+                doc.metadata = {}
+            doc.metadata['source'] = os.path.basename(file_path)
+            doc.metadata['file_path'] = file_path
+        
+        return documents
+        
+    except Exception as e:
+        raise DocumentLoadingError(f"加载文档失败: {str(e)}")
+
+
 class DocumentLoadingError(Exception):
     """文档加载异常"""
     pass
\ No newline at end of file
@@ -1,7 +1,14 @@
 import os
+import re
+import json
 import time
-import uuid
-from typing import List, Dict, Any, Optional
+import random
+import hashlib
+import tempfile
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Iterator, List, Dict, Any, Optional
 from datetime import datetime
 
 from .document_processor import DocumentProcessor
@@ -10,6 +17,9 @@ from .vectorizer import Vectorizer
 from .vector_store import FAISSVectorStore
 from utils.config import config
 
+# 构建时暂存文本块的列式文件结构，元数据字段因文档类型而异，以JSON保存
+_SPOOL_SCHEMA = pa.schema([('text', pa.string()), ('metadata', pa.string())])
+
 class KnowledgeBaseBuilder:
     """知识库构建器，协调整个处理流程"""
     
@@ -49,8 +59,143 @@ class KnowledgeBaseBuilder:
             
             print("开始构建知识库...")
             
+            # 在新的向量存储中构建，全部写入并保存成功后才替换现有知识库
+            store = FAISSVectorStore(self.vector_store.index_path)
+            
+            # 1. 流式加载并分割文档，文本块暂存到磁盘，内存占用与语料规模无关
+            batch_size = max(self.vectorizer.batch_size, config.get('faiss.build_batch_size', 4096))
+            fd, spool_file = tempfile.mkstemp(suffix='.parquet', dir=self.vector_store.index_path)
+            os.close(fd)
+            
+            try:
+                document_count, chunk_count = self._spool_chunks(spool_file, batch_size)
+                
+                if document_count == 0:
+                    return {
+                        'success': False,
+                        'message': '没有找到可处理的文档',
+                        'time_elapsed': time.time() - start_time
+                    }
+                
+                if chunk_count == 0:
+                    return {
+                        'success': False,
+                        'message': '文档分割失败',
+                        'time_elapsed': time.time() - start_time
+                    }
+                
+                print(f"✓ 加载 {document_count} 个文档片段，分割为 {chunk_count} 个文本块")
+                
+                # 2. 按语料总量创建索引，训练样本从全部文本块中随机抽取
+                training_vectors = None
+                sample_rows = []
+                sample_size = store.training_size(chunk_count)
+                if sample_size:
+                    sample_rows = sorted(random.Random(0).sample(range(chunk_count), sample_size))
+                    print(f"抽取 {sample_size} 个文本块训练索引...")
+                    training_vectors = self.vectorizer.embed_texts(
+                        self._read_spooled_texts(spool_file, sample_rows, batch_size)
+                    )
+                store.create_index(self.vectorizer.get_dimension(), chunk_count, training_vectors)
+                
+                # 3. 分批向量化并写入索引，训练样本已有向量，直接复用
+                print("开始向量化...")
+                offset = 0
+                sample_pos = 0
+                for texts, metadatas in self._iter_spooled_chunks(spool_file, batch_size):
+                    sample_start = sample_pos
+                    while sample_pos < len(sample_rows) and sample_rows[sample_pos] < offset + len(texts):
+                        sample_pos += 1
+                    embeddings = self._embed_batch(
+                        texts,
+                        np.asarray(sample_rows[sample_start:sample_pos], dtype=np.int64) - offset,
+                        training_vectors[sample_start:sample_pos] if sample_pos > sample_start else None
+                    )
+                    store.add_to_index(embeddings, metadatas)
+                    offset += len(texts)
+            finally:
+                os.remove(spool_file)
+            
+            # 保存索引
+            store.save_index()
+            self.vector_store = store
+            
+            time_elapsed = time.time() - start_time
+            stats = self.vector_store.get_index_stats()
+            stats['total_chunks'] = chunk_count
+            
+            print(f"✓ 知识库构建完成，耗时: {time_elapsed:.2f}秒")
+            
+            return {
+                'success': True,
+                'message': '知识库构建成功',
+                'stats': stats,
+                'time_elapsed': time_elapsed
+            }
+            
+        except Exception as e:
+            return {
+                'success': False,
+                'message': f'知识库构建失败: {str(e)}',
+                'time_elapsed': time.time() - start_time
+            }
+    
+    def add_documents(self, file_paths: List[str]) -> Dict[str, Any]:
+        """
+        增量添加文档到知识库，只处理尚未索引的文件
+        
+        索引按文件名记录已收录的文件，因此只接受上传目录中的文件
+        （上传文件以内容哈希命名，同名即同内容）。
+        
+        Args:
+            file_paths: 上传目录中的文件路径列表
+            
+        Returns:
+            Dict: 添加结果
+        """
+        start_time = time.time()
+        
+        try:
+            # 在现有索引上追加，磁盘上没有索引时才新建
+            if self.vector_store.index is None and not self.vector_store.load_index():
+                if self.vector_store.index_exists():
+                    return {
+                        'success': False,
+                        'message': '现有索引无法加载，请重建知识库',
+                        'time_elapsed': time.time() - start_time
+                    }
+            
+            upload_dir = os.path.realpath(self.upload_dir)
+            outside = [
+                path for path in file_paths
+                if os.path.dirname(os.path.realpath(path)) != upload_dir
+            ]
+            if outside:
+                return {
+                    'success': False,
+                    'message': f'只能添加上传目录中的文件: {", ".join(outside)}',
+                    'time_elapsed': time.time() - start_time
+                }
+            
+            new_paths = [
+                path for path in file_paths
+                if os.path.basename(path) not in self.vector_store.file_ranges
+            ]
+            if not new_paths:
+                return {
+                    'success': True,
+                    'message': '文档已在知识库中',
+                    'stats': self.vector_store.get_index_stats(),
+                    'time_elapsed': time.time() - start_time
+                }
+            
             # 1. 加载文档
-            documents = self._load_all_documents()
+            documents = []
+            for file_path, loaded, error in self.document_processor.load_documents(new_paths):
+                if error is None:
+                    documents.extend(loaded)
+                else:
+                    print(f"  ✗ 加载失败: {os.path.basename(file_path)} - {error}")
             if not documents:
                 return {
                     'success': False,
@@ -58,8 +203,6 @@ class KnowledgeBaseBuilder:
                     'time_elapsed': time.time() - start_time
                 }
             
-            print(f"✓ 加载 {len(documents)} 个文档片段")
-            
             # 2. 分割文档
             chunks = self.text_splitter.split_documents(documents)
             if not chunks:
@@ -69,14 +212,14 @@ class KnowledgeBaseBuilder:
                     'time_elapsed': time.time() - start_time
                 }
             
-            print(f"✓ 分割为 {len(chunks)} 个文本块")
+            # 块序号接着现有索引继续编号，与构建时的全局编号一致
+            chunk_offset = self.vector_store.metadata.num_rows
+            for i, chunk in enumerate(chunks):
+                chunk.metadata['chunk_index'] = chunk_offset + i
             
-            # 3. 提取文本和元数据
+            # 3. 向量化
             texts = [chunk.page_content for chunk in chunks]
             metadatas = [chunk.metadata for chunk in chunks]
-            
-            # 4. 向量化
-            print("开始向量化...")
             embeddings = self.vectorizer.embed_texts(texts)
             if embeddings.size == 0:
                 return {
@@ -85,68 +228,145 @@ class KnowledgeBaseBuilder:
                     'time_elapsed': time.time() - start_time
                 }
             
-            print(f"✓ 向量化完成，维度: {embeddings.shape}")
-            
-            # 5. 构建索引
-            self.vector_store.build_index(embeddings, metadatas)
-            
-            # 6. 保存索引
+            # 4. 追加到索引并保存
+            self.vector_store.add_to_index(embeddings, metadatas)
             self.vector_store.save_index()
             
             time_elapsed = time.time() - start_time
-            stats = self.vector_store.get_index_stats()
-            
-            print(f"✓ 知识库构建完成，耗时: {time_elapsed:.2f}秒")
+            print(f"✓ 新增 {len(new_paths)} 个文档（{len(chunks)} 个文本块），耗时: {time_elapsed:.2f}秒")
             
             return {
                 'success': True,
-                'message': '知识库构建成功',
-                'stats': stats,
+                'message': '文档添加成功',
+                'stats': self.vector_store.get_index_stats(),
                 'time_elapsed': time_elapsed
             }
             
         except Exception as e:
             return {
                 'success': False,
-                'message': f'知识库构建失败: {str(e)}',
+                'message': f'文档添加失败: {str(e)}',
                 'time_elapsed': time.time() - start_time
             }
     
-    def _load_all_documents(self) -> List:
-        """加载上传目录中的所有文档"""
-        all_documents = []
+    def _embed_batch(self, texts: List[str], known_rows: np.ndarray,
+                     known_vectors: Optional[np.ndarray]) -> np.ndarray:
+        """向量化一批文本，known_rows 行已有向量 known_vectors，只对其余文本编码"""
+        if known_vectors is None:
+            embeddings = self.vectorizer.embed_texts(texts)
+            if embeddings.size == 0:
+                raise ValueError('向量化失败')
+            return embeddings
+        
+        embeddings = np.empty((len(texts), known_vectors.shape[1]), dtype=np.float32)
+        embeddings[known_rows] = known_vectors
+        
+        pending = np.ones(len(texts), dtype=bool)
+        pending[known_rows] = False
+        if pending.any():
+            encoded = self.vectorizer.embed_texts([text for text, p in zip(texts, pending) if p])
+            if encoded.size == 0:
+                raise ValueError('向量化失败')
+            embeddings[pending] = encoded
+        return embeddings
+    
+    def _spool_chunks(self, spool_file: str, batch_size: int):
+        """
+        加载并分割上传目录中的全部文档，文本块分批写入暂存文件
+        
+        Returns:
+            Tuple[int, int]: (文档片段数, 文本块数)
+        """
+        document_count = 0
+        chunk_count = 0
+        texts, metadatas = [], []
+        
+        def write_batch():
+            writer.write_table(pa.table({'text': texts, 'metadata': metadatas}, schema=_SPOOL_SCHEMA))
+            texts.clear()
+            metadatas.clear()
+        
+        with pq.ParquetWriter(spool_file, _SPOOL_SCHEMA) as writer:
+            for documents in self._iter_documents():
+                document_count += len(documents)
+                
+                for chunk in self.text_splitter.split_documents(documents):
+                    # 块序号在整个知识库内连续
+                    chunk.metadata['chunk_index'] = chunk_count
+                    chunk_count += 1
+                    texts.append(chunk.page_content)
+                    metadatas.append(json.dumps(chunk.metadata, ensure_ascii=False, default=str))
+                    if len(texts) >= batch_size:
+                        write_batch()
+            
+            if texts:
+                write_batch()
         
+        return document_count, chunk_count
+    
+    @staticmethod
+    def _iter_spooled_chunks(spool_file: str, batch_size: int) -> Iterator:
+        """分批读取暂存的文本块，产出 (文本列表, 元数据列表)"""
+        for batch in pq.ParquetFile(spool_file).iter_batches(batch_size=batch_size):
+            texts = batch.column('text').to_pylist()
+            metadatas = [json.loads(meta) for meta in batch.column('metadata').to_pylist()]
+            yield texts, metadatas
+    
+    @staticmethod
+    def _read_spooled_texts(spool_file: str, rows: List[int], batch_size: int) -> List[str]:
+        """按行号（升序）读取暂存文件中的部分文本"""
+        texts = []
+        offset = 0
+        pos = 0
+        for batch in pq.ParquetFile(spool_file).iter_batches(batch_size=batch_size, columns=['text']):
+            end = offset + batch.num_rows
+            local_rows = []
+            while pos < len(rows) and rows[pos] < end:
+                local_rows.append(rows[pos] - offset)
+                pos += 1
+            if local_rows:
+                texts.extend(batch.column('text').take(pa.array(local_rows)).to_pylist())
+            offset = end
+        return texts
+    
+    def _iter_documents(self) -> Iterator[List]:
+        """逐个文件加载上传目录中的文档，每次产出一个文件的文档列表"""
         # 检查上传目录是否存在
         if not os.path.exists(self.upload_dir):
             print(f"上传目录不存在: {self.upload_dir}")
-            return all_documents
+            return
         
         # 遍历上传目录
-        for filename in os.listdir(self.upload_dir):
-            file_path = os.path.join(self.upload_dir, filename)
-            
-            # 只处理支持的文件
-            ext = os.path.splitext(filename)[1].lower()
-            if ext not in self.document_processor.supported_extensions:
-                continue
-            
-            # 检查文件大小
-            file_size_mb = os.path.getsize(file_path) / (1024 * 1024)
-            max_size = config.get('document.max_file_size_mb', 50)
-            if file_size_mb > max_size:
-                print(f"跳过文件（超过大小限制）: {filename} ({file_size_mb:.1f}MB)")
-                continue
-            
-            try:
-                print(f"加载文档: {filename}")
-                documents = self.document_processor.load_document(file_path)
-                all_documents.extend(documents)
-                print(f"  ✓ 成功加载 {len(documents)} 个文档片段")
-            except Exception as e:
-                print(f"  ✗ 加载失败: {e}")
-                continue
+        file_paths = []
+        max_size = config.get('document.max_file_size_mb', 50)
+        with os.scandir(self.upload_dir) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                
+                # 只处理支持的文件
+                ext = os.path.splitext(entry.name)[1].lower()
+                if ext not in self.document_processor.supported_extensions:
+                    continue
+                
+                # 检查文件大小
+                file_size_mb = entry.stat().st_size / (1024 * 1024)
+                if file_size_mb > max_size:
+                    print(f"跳过文件（超过大小限制）: {entry.name} ({file_size_mb:.1f}MB)")
+                    continue
+                
+                file_paths.append(entry.path)
         
-        return all_documents
+        # 多进程并行加载，按文件逐个产出
+        for file_path, documents, error in self.document_processor.iter_documents(file_paths):
+            filename = os.path.basename(file_path)
+            print(f"加载文档: {filename}")
+            if error is None:
+                print(f"  ✓ 成功加载 {len(documents)} 个文档片段")
+                if documents:
+                    yield documents
+            else:
+                print(f"  ✗ 加载失败: {error}")
     
     def search(self, query: str, k: Optional[int] = None) -> List[Dict]:
         """
@@ -188,8 +408,9 @@ class KnowledgeBaseBuilder:
 class DocumentUploadManager:
     """文档上传管理器"""
     
-    def __init__(self, upload_dir: Optional[str] = None):
+    def __init__(self, upload_dir: Optional[str] = None, builder: Optional[KnowledgeBaseBuilder] = None):
         self.upload_dir = upload_dir or config.get('system.upload_dir', './uploads')
+        self.builder = builder
         self.processed_files = set()
         
         # 创建上传目录
@@ -207,53 +428,63 @@ class DocumentUploadManager:
             Dict: 上传结果
         """
         try:
-            # 生成唯一文件名
-            unique_filename = self._generate_unique_filename(filename)
-            file_path = os.path.join(self.upload_dir, unique_filename)
-            
-            # 保存文件
             if hasattr(file_obj, 'read'):
                 content = file_obj.read()
             else:
                 content = file_obj
             
-            with open(file_path, 'wb') as f:
-                f.write(content)
+            # 按内容哈希生成文件名，相同内容对应同一文件
+            content_hash = hashlib.blake2b(content, digest_size=6).hexdigest()
+            unique_filename = self._generate_unique_filename(filename, content_hash)
+            file_path = os.path.join(self.upload_dir, unique_filename)
+            
+            # 保存文件，相同内容重复上传时跳过写入
+            duplicate = os.path.exists(file_path)
+            if not duplicate:
+                # 先写入临时文件再重命名，避免留下不完整的文档
+                with open(file_path + '.part', 'wb') as f:
+                    f.write(content)
+                os.replace(file_path + '.part', file_path)
             
             # 记录处理状态
             self.processed_files.add(unique_filename)
             
-            return {
+            result = {
                 'success': True,
-                'message': f"文档上传成功: {unique_filename}",
+                'duplicate': duplicate,
+                'message': f"文档{'已存在' if duplicate else '上传成功'}: {unique_filename}",
                 'filename': unique_filename,
                 'file_path': file_path
             }
             
+            # 关联了知识库时增量索引新文档
+            if self.builder is not None:
+                result['index_result'] = self.builder.add_documents([file_path])
+            
+            return result
+            
         except Exception as e:
             return {
                 'success': False,
                 'message': f"文档上传失败: {str(e)}"
             }
     
-    def _generate_unique_filename(self, filename: str) -> str:
-        """生成唯一文件名"""
+    def _generate_unique_filename(self, filename: str, content_hash: str) -> str:
+        """根据原始文件名和内容哈希生成文件名"""
         name, ext = os.path.splitext(filename)
-        timestamp = int(time.time())
-        unique_id = str(uuid.uuid4())[:8]
         
         # 清理文件名中的特殊字符
         clean_name = re.sub(r'[^\w\-\.]', '_', name)
         
-        return f"{clean_name}_{timestamp}_{unique_id}{ext}"
+        return f"{clean_name}_{content_hash}{ext}"
     
     def clear_upload_dir(self) -> Dict[str, Any]:
         """清空上传目录"""
         try:
-            for filename in os.listdir(self.upload_dir):
-                file_path = os.path.join(self.upload_dir, filename)
-                if os.path.isfile(file_path):
-                    os.remove(file_path)
+            with os.scandir(self.upload_dir) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        os.remove(entry.path)
             
             self.processed_files.clear()
             
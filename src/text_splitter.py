@@ -1,9 +1,39 @@
-import re
+import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import List
+from langchain.schema import Document
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 
 from utils.config import config
 
+try:
+    from ._length_numba import weighted_length as _numba_weighted_length
+except ImportError:
+    _numba_weighted_length = None
+
+try:
+    from semantic_text_splitter import TextSplitter as _RustTextSplitter
+except ImportError:
+    _RustTextSplitter = None
+
+
+class _RustSplitterAdapter:
+    """将Rust实现的 semantic_text_splitter 适配为LangChain分割器接口"""
+    
+    def __init__(self, chunk_size: int, chunk_overlap: int):
+        # 容量按字符计算，每个中文字符算1
+        self._splitter = _RustTextSplitter(chunk_size, overlap=chunk_overlap, trim=True)
+    
+    def split_text(self, text: str) -> List[str]:
+        return self._splitter.chunks(text)
+    
+    def split_documents(self, documents: List) -> List:
+        return [
+            Document(page_content=chunk_text, metadata=dict(doc.metadata))
+            for doc in documents
+            for chunk_text in self.split_text(doc.page_content)
+        ]
+
 class ChineseSemanticSplitter:
     """中文语义文本分割器"""
     
@@ -11,14 +41,22 @@ class ChineseSemanticSplitter:
         self.chunk_size = config.get('text_splitter.chunk_size', 800)
         self.chunk_overlap = config.get('text_splitter.chunk_overlap', 150)
         self.separators = config.get('text_splitter.separators', [])
+        self.backend = config.get('text_splitter.backend', 'rust')
+        # 多文档并行分割使用的线程池，首次需要时创建并复用
+        self._executor = None
         
-        self.splitter = RecursiveCharacterTextSplitter(
-            separators=self.separators,
-            chunk_size=self.chunk_size,
-            chunk_overlap=self.chunk_overlap,
-            length_function=self._chinese_aware_length,
-            is_separator_regex=False
-        )
+        # 优先使用Rust分割器，未安装时回退到LangChain实现
+        if self.backend == 'rust' and _RustTextSplitter is not None:
+            self.splitter = _RustSplitterAdapter(self.chunk_size, self.chunk_overlap)
+        else:
+            self.backend = 'langchain'
+            self.splitter = RecursiveCharacterTextSplitter(
+                separators=self.separators,
+                chunk_size=self.chunk_size,
+                chunk_overlap=self.chunk_overlap,
+                length_function=self._chinese_aware_length,
+                is_separator_regex=False
+            )
     
     def _chinese_aware_length(self, text: str) -> int:
         """
@@ -33,15 +71,24 @@ class ChineseSemanticSplitter:
         if not text:
             return 0
         
-        # 中文字符每个算1，英文字符每2个算1
-        chinese_chars = re.findall(r'[\u4e00-\u9fff]', text)
-        english_chars = re.findall(r'[a-zA-Z]', text)
-        other_chars = re.findall(r'[^\u4e00-\u9fffa-zA-Z\s]', text)
+        # 安装了numba时使用JIT编译的实现
+        if _numba_weighted_length is not None:
+            return _numba_weighted_length(text)
         
-        # 计算加权长度
-        length = len(chinese_chars) + len(other_chars) + (len(english_chars) // 2 + len(english_chars) % 2)
+        # 中文字符每个算1，英文字符每2个算1，单次遍历统计
+        chinese_chars = 0
+        english_chars = 0
+        other_chars = 0
+        for ch in text:
+            if '\u4e00' <= ch <= '\u9fff':
+                chinese_chars += 1
+            elif ch.isascii() and ch.isalpha():
+                english_chars += 1
+            elif not ch.isspace():
+                other_chars += 1
         
-        return length
+        # 计算加权长度
+        return chinese_chars + other_chars + (english_chars + 1) // 2
     
     def split_documents(self, documents: List) -> List:
         """
@@ -56,19 +103,24 @@ class ChineseSemanticSplitter:
         if not documents:
             return []
         
-        # 分割文档
-        chunks = self.splitter.split_documents(documents)
+        # 分割文档，多个文档时按文档并行分割
+        if len(documents) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 1)
+            chunk_lists = list(self._executor.map(
+                self.splitter.split_documents, [[doc] for doc in documents]
+            ))
+            chunks = [chunk for chunk_list in chunk_lists for chunk in chunk_list]
+        else:
+            chunks = self.splitter.split_documents(documents)
         
-        # 为每个块添加元数据
+        # 为每个块添加元数据，总块数由知识库构建结果统一给出
         for i, chunk in enumerate(chunks):
             chunk.metadata['chunk_index'] = i
-            chunk.metadata['total_chunks'] = len(chunks)
             
-            # 添加文本摘要（前50个字符）
-            if len(chunk.page_content) > 50:
-                chunk.metadata['summary'] = chunk.page_content[:50] + "..."
-            else:
-                chunk.metadata['summary'] = chunk.page_content
+            # 添加文本摘要（前50个字符），索引中不保存原文，检索结果依赖此字段
+            content = chunk.page_content
+            chunk.metadata['summary'] = content[:50] + "..." if len(content) > 50 else content
         
         print(f"文档分割完成，得到 {len(chunks)} 个文本块")
         return chunks
@@ -95,7 +147,6 @@ class ChineseSemanticSplitter:
         for i, chunk_text in enumerate(chunks):
             chunk_metadata = metadata.copy() if metadata else {}
             chunk_metadata['chunk_index'] = i
-            chunk_metadata['total_chunks'] = len(chunks)
             
             results.append({
                 'text': chunk_text,
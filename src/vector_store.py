@@ -1,12 +1,21 @@
 import os
+import json
+import math
 import pickle
 import numpy as np
 import faiss
+import pyarrow as pa
+import pyarrow.parquet as pq
 from typing import List, Dict, Any, Optional
 from datetime import datetime
 
 from utils.config import config
 
+# FAISS聚类要求每个中心至少有39个训练点
+_MIN_POINTS_PER_CENTROID = 39
+# 标量量化（int8）训练只需估计取值范围，抽样即可
+_SQ_TRAINING_SIZE = 65536
+
 class FAISSVectorStore:
     """FAISS向量数据库管理器"""
     
@@ -15,9 +24,21 @@ class FAISSVectorStore:
         self.index_name = config.get('system.index_name', 'default')
         self.use_gpu = config.get('faiss.use_gpu', True)
         self.search_k = config.get('faiss.search_k', 5)
+        self.index_type = config.get('faiss.index_type', 'auto')
+        self.quantizer = config.get('faiss.quantizer', 'fp16')
+        self.normalize = config.get('faiss.normalize', False)
+        self.use_mmap = config.get('faiss.mmap', True)
+        
+        # 设置FAISS的OpenMP线程数，0表示使用全部CPU核心
+        faiss.omp_set_num_threads(config.get('faiss.num_threads', 0) or os.cpu_count() or 1)
         
         self.index = None
-        self.metadata = []
+        # 元数据以列式表存储，每行对应一个向量
+        self.metadata = pa.table({})
+        # 已索引文件清单：文件名 -> [起始行, 结束行)
+        self.file_ranges: Dict[str, List[int]] = {}
+        # 以只读内存映射方式加载的索引文件，追加向量前需重新加载
+        self._mmap_file = None
         
         # 创建目录
         os.makedirs(self.index_path, exist_ok=True)
@@ -27,7 +48,7 @@ class FAISSVectorStore:
         构建向量索引
         
         Args:
-            embeddings: 向量矩阵
+            embeddings: 向量矩阵，开启 faiss.normalize 时会被原地归一化
             metadatas: 元数据列表
             
         Returns:
@@ -37,34 +58,210 @@ class FAISSVectorStore:
             print("警告: 没有向量可以构建索引")
             return False
         
-        dimension = embeddings.shape[1]
+        try:
+            # 已是float32且C连续时不复制（Vectorizer的输出即满足）
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            
+            # 需要训练的索引直接用全部向量训练
+            self.create_index(embeddings.shape[1], len(embeddings), embeddings)
+            self.add_to_index(embeddings, metadatas)
+            
+            print(f"索引构建完成，包含 {len(metadatas)} 个向量")
+            return True
+            
+        except IndexBuildError:
+            raise
+        except Exception as e:
+            raise IndexBuildError(f"构建索引失败: {str(e)}")
+    
+    def create_index(self, dimension: int, num_vectors: int,
+                     training_vectors: Optional[np.ndarray] = None):
+        """
+        按语料总量创建空索引，之后通过 add_to_index 分批写入向量
         
+        Args:
+            dimension: 向量维度
+            num_vectors: 语料中的向量总数，决定索引类型和IVF聚类数
+            training_vectors: 训练样本，数量应为 training_size(num_vectors)，
+                开启 faiss.normalize 时会被原地归一化
+        """
         try:
-            # 创建索引
-            self.index = faiss.IndexFlatIP(dimension)  # 内积相似度
+            index = self._create_index(dimension, num_vectors)
+            
+            if not index.is_trained:
+                if training_vectors is None or len(training_vectors) == 0:
+                    raise ValueError("该索引类型需要训练向量")
+                training_vectors = np.ascontiguousarray(training_vectors, dtype=np.float32)
+                if self.normalize:
+                    faiss.normalize_L2(training_vectors)
+                index.train(training_vectors)
             
             # 转移到GPU（如果可用）
             if self.use_gpu and faiss.get_num_gpus() > 0:
                 try:
                     res = faiss.StandardGpuResources()
-                    self.index = faiss.index_cpu_to_gpu(res, 0, self.index)
+                    index = faiss.index_cpu_to_gpu(res, 0, index)
                     print("使用GPU加速FAISS索引")
                 except Exception as e:
                     print(f"GPU加速失败，使用CPU: {e}")
             
-            # 添加向量
-            self.index.add(embeddings.astype(np.float32))
-            self.metadata = metadatas
+            self.index = index
+            self._mmap_file = None
+            self.metadata = pa.table({})
+            self.file_ranges = {}
             
-            # 添加时间戳
-            for meta in self.metadata:
-                meta['indexed_at'] = datetime.now().isoformat()
+        except Exception as e:
+            raise IndexBuildError(f"创建索引失败: {str(e)}")
+    
+    def training_size(self, num_vectors: int) -> int:
+        """返回为 num_vectors 个向量建索引所需的训练样本数，不需要训练时为0"""
+        index_type = self._resolve_index_type(num_vectors)
+        if index_type == 'ivfpq':
+            return min(num_vectors, _MIN_POINTS_PER_CENTROID * self._ivf_nlist(num_vectors))
+        if self.quantizer == 'int8':
+            return min(num_vectors, _SQ_TRAINING_SIZE)
+        return 0
+    
+    def add_to_index(self, embeddings: np.ndarray, metadatas: List[Dict]) -> bool:
+        """
+        向现有索引追加向量，索引不存在时直接构建
+        
+        Args:
+            embeddings: 向量矩阵，开启 faiss.normalize 时会被原地归一化
+            metadatas: 元数据列表
             
-            print(f"索引构建完成，包含 {len(metadatas)} 个向量")
+        Returns:
+            bool: 是否成功
+        """
+        if embeddings.size == 0:
+            print("警告: 没有向量可以添加")
+            return False
+        
+        if self.index is None:
+            return self.build_index(embeddings, metadatas)
+        
+        try:
+            # 只读内存映射的索引无法追加，重新完整加载
+            if self._mmap_file is not None:
+                self.index = faiss.read_index(self._mmap_file)
+                self._mmap_file = None
+            
+            # 已是float32且C连续时不复制（Vectorizer的输出即满足）
+            embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+            if self.normalize:
+                faiss.normalize_L2(embeddings)
+            
+            # 先合并元数据，成功后再添加向量，避免索引中出现没有元数据的向量
+            new_table = self._to_table(metadatas)
+            if self.metadata.num_rows == 0:
+                metadata = new_table
+            else:
+                metadata = pa.concat_tables([self.metadata, new_table], promote_options='permissive')
+            
+            start = self.index.ntotal
+            self.index.add(embeddings)
+            self.metadata = metadata
+            # 合并行区间，跨批次的文件保留原起始行
+            new_ranges = self._compute_file_ranges([meta.get('source') for meta in metadatas], start)
+            for source, (range_start, range_end) in new_ranges.items():
+                if source in self.file_ranges:
+                    self.file_ranges[source][1] = range_end
+                else:
+                    self.file_ranges[source] = [range_start, range_end]
+            
+            print(f"索引追加完成，新增 {len(metadatas)} 个向量")
             return True
             
         except Exception as e:
-            raise IndexBuildError(f"构建索引失败: {str(e)}")
+            raise IndexBuildError(f"追加索引失败: {str(e)}")
+    
+    def _to_table(self, metadatas: List[Dict]) -> pa.Table:
+        """添加时间戳并转换为列式表"""
+        indexed_at = datetime.now().isoformat()
+        return self._rows_to_table(
+            [{**meta, 'indexed_at': indexed_at} for meta in metadatas]
+        )
+    
+    @staticmethod
+    def _rows_to_table(rows: List[Dict]) -> pa.Table:
+        """
+        将元数据字典列表转换为列式表
+        
+        列取所有行字段的并集，某行缺少的字段记为null
+        （Table.from_pylist 只按第一行推断列，会丢弃其他行独有的字段）
+        """
+        keys = dict.fromkeys(key for row in rows for key in row)
+        return pa.Table.from_pydict({key: [row.get(key) for row in rows] for key in keys})
+    
+    @staticmethod
+    def _compute_file_ranges(sources: List[Optional[str]], start: int) -> Dict[str, List[int]]:
+        """按来源文件统计向量所在的行区间"""
+        ranges = {}
+        for i, source in enumerate(sources, start):
+            if source is None:
+                continue
+            if source in ranges:
+                ranges[source][1] = i + 1
+            else:
+                ranges[source] = [i, i + 1]
+        return ranges
+    
+    def _create_index(self, dimension: int, num_vectors: int):
+        """
+        根据配置和向量数量选择索引类型
+        
+        auto: 向量数不少于4096时使用IVFPQFastScan，否则使用HNSW
+        """
+        index_type = self._resolve_index_type(num_vectors)
+        
+        # 标量量化降低向量存储精度（PQ索引本身已压缩，不再叠加）
+        qtype = self._scalar_quantizer_type()
+        
+        if index_type == 'flat':
+            if qtype is None:
+                return faiss.IndexFlatIP(dimension)  # 内积相似度
+            return faiss.IndexScalarQuantizer(dimension, qtype, faiss.METRIC_INNER_PRODUCT)
+        
+        if index_type == 'hnsw':
+            if qtype is None:
+                return faiss.IndexHNSWFlat(dimension, 32, faiss.METRIC_INNER_PRODUCT)
+            return faiss.IndexHNSWSQ(dimension, qtype, 32, faiss.METRIC_INNER_PRODUCT)
+        
+        if index_type == 'ivfpq':
+            nlist = self._ivf_nlist(num_vectors)
+            quantizer = faiss.IndexFlatIP(dimension)
+            index = faiss.IndexIVFPQFastScan(
+                quantizer, dimension, nlist, dimension // 4, 4,
+                faiss.METRIC_INNER_PRODUCT
+            )
+            index.nprobe = max(1, nlist // 32)
+            # 量化器需随索引一起保留
+            index.own_fields = True
+            quantizer.this.disown()
+            return index
+        
+        raise ValueError(f"不支持的索引类型: {index_type}")
+    
+    def _resolve_index_type(self, num_vectors: int) -> str:
+        """解析 auto 索引类型"""
+        if self.index_type == 'auto':
+            return 'ivfpq' if num_vectors >= 4096 else 'hnsw'
+        return self.index_type
+    
+    @staticmethod
+    def _ivf_nlist(num_vectors: int) -> int:
+        """IVF聚类数：约 4*sqrt(N)，且保证每个中心至少有39个训练点"""
+        return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // _MIN_POINTS_PER_CENTROID))
+    
+    def _scalar_quantizer_type(self):
+        """将配置的量化方式转换为FAISS标量量化类型，none表示保持float32"""
+        if self.quantizer == 'fp16':
+            return faiss.ScalarQuantizer.QT_fp16
+        if self.quantizer == 'int8':
+            return faiss.ScalarQuantizer.QT_8bit
+        if self.quantizer in (None, 'none'):
+            return None
+        raise ValueError(f"不支持的量化方式: {self.quantizer}")
     
     def save_index(self, name: Optional[str] = None) -> bool:
         """保存索引到磁盘"""
@@ -74,42 +271,69 @@ class FAISSVectorStore:
         
         name = name or self.index_name
         index_file = os.path.join(self.index_path, f"{name}.index")
-        meta_file = os.path.join(self.index_path, f"{name}_meta.pkl")
+        meta_file = os.path.join(self.index_path, f"{name}_meta.parquet")
+        files_file = os.path.join(self.index_path, f"{name}_files.json")
         
         try:
+            # 先写入临时文件再原子替换，中途崩溃不会损坏已有索引
             # 如果是GPU索引，先转换到CPU
             if faiss.get_num_gpus() > 0 and hasattr(self.index, 'device'):  # GPU索引
                 cpu_index = faiss.index_gpu_to_cpu(self.index)
-                faiss.write_index(cpu_index, index_file)
+                faiss.write_index(cpu_index, index_file + '.tmp')
             else:  # CPU索引
-                faiss.write_index(self.index, index_file)
+                faiss.write_index(self.index, index_file + '.tmp')
             
             # 保存元数据
-            with open(meta_file, 'wb') as f:
-                pickle.dump(self.metadata, f)
+            pq.write_table(self.metadata, meta_file + '.tmp', compression='zstd')
+            
+            # 保存文件清单
+            with open(files_file + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(self.file_ranges, f, ensure_ascii=False)
+            
+            # 索引文件最后替换，加载时以向量数与元数据行数是否一致判断完整性
+            for path in (meta_file, files_file, index_file):
+                os.replace(path + '.tmp', path)
             
             print(f"索引已保存: {index_file}")
             return True
             
         except Exception as e:
+            # 清理未替换的临时文件
+            for path in (meta_file, files_file, index_file):
+                if os.path.exists(path + '.tmp'):
+                    os.remove(path + '.tmp')
             raise IndexSaveError(f"保存索引失败: {str(e)}")
     
+    def index_exists(self, name: Optional[str] = None) -> bool:
+        """磁盘上是否存在该索引的任一文件"""
+        name = name or self.index_name
+        return any(
+            os.path.exists(os.path.join(self.index_path, f"{name}{suffix}"))
+            for suffix in ('.index', '_meta.parquet', '_meta.pkl')
+        )
+    
     def load_index(self, name: Optional[str] = None) -> bool:
         """从磁盘加载索引"""
         name = name or self.index_name
         index_file = os.path.join(self.index_path, f"{name}.index")
-        meta_file = os.path.join(self.index_path, f"{name}_meta.pkl")
+        meta_file = os.path.join(self.index_path, f"{name}_meta.parquet")
+        legacy_meta_file = os.path.join(self.index_path, f"{name}_meta.pkl")
+        files_file = os.path.join(self.index_path, f"{name}_files.json")
+        
+        # 兼容旧版本的pickle元数据
+        if not os.path.exists(meta_file) and os.path.exists(legacy_meta_file):
+            meta_file = legacy_meta_file
         
         if not os.path.exists(index_file) or not os.path.exists(meta_file):
             print(f"索引文件不存在: {index_file}")
             return False
         
         try:
-            # 加载索引
-            self.index = faiss.read_index(index_file)
+            # 加载索引，内存映射方式按需读入向量
+            self.index, self._mmap_file = self._read_index(index_file)
             
-            # 转移到GPU（如果可用）
-            if self.use_gpu and faiss.get_num_gpus() > 0:
+            # 转移到GPU（如果可用），GPU需要独占内存，内存映射时不转移
+            if self._mmap_file is None and self.use_gpu and faiss.get_num_gpus() > 0:
                 try:
                     res = faiss.StandardGpuResources()
                     self.index = faiss.index_cpu_to_gpu(res, 0, self.index)
@@ -117,15 +341,59 @@ class FAISSVectorStore:
                     print(f"GPU加速失败: {e}")
             
             # 加载元数据
-            with open(meta_file, 'rb') as f:
-                self.metadata = pickle.load(f)
+            if meta_file == legacy_meta_file:
+                with open(meta_file, 'rb') as f:
+                    self.metadata = self._rows_to_table(pickle.load(f))
+            else:
+                self.metadata = pq.read_table(meta_file, memory_map=True)
+            
+            # 加载文件清单，旧版本索引没有清单时从元数据恢复
+            if os.path.exists(files_file):
+                with open(files_file, 'r', encoding='utf-8') as f:
+                    self.file_ranges = json.load(f)
+            elif 'source' in self.metadata.column_names:
+                self.file_ranges = self._compute_file_ranges(self.metadata.column('source').to_pylist(), 0)
+            else:
+                self.file_ranges = {}
+            
+            # 保存中途崩溃可能导致索引与元数据不匹配，此时需要重建
+            if self.index.ntotal != self.metadata.num_rows:
+                print(f"索引与元数据不一致（{self.index.ntotal} 个向量，{self.metadata.num_rows} 行元数据），需要重建")
+                self.index = None
+                self._mmap_file = None
+                self.metadata = pa.table({})
+                self.file_ranges = {}
+                return False
             
-            print(f"索引加载成功，包含 {len(self.metadata)} 个向量")
+            print(f"索引加载成功，包含 {self.metadata.num_rows} 个向量")
             return True
             
         except Exception as e:
             raise IndexLoadError(f"加载索引失败: {str(e)}")
     
+    def _read_index(self, index_file: str):
+        """
+        读取索引文件
+        
+        Returns:
+            Tuple: (索引, 实际以内存映射方式加载时的文件路径，否则为None)
+        """
+        if not self.use_mmap:
+            return faiss.read_index(index_file), None
+        
+        # IO_FLAG_MMAP 只映射IVF倒排表，较新的FAISS可用 IO_FLAG_MMAP_IFC 映射全部类型的向量数据
+        ifc_flag = getattr(faiss, 'IO_FLAG_MMAP_IFC', 0)
+        if ifc_flag:
+            try:
+                index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | ifc_flag | faiss.IO_FLAG_READ_ONLY)
+                return index, index_file
+            except RuntimeError:
+                pass  # 部分索引格式不支持，退回仅映射倒排表
+        
+        index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        mapped = faiss.try_extract_index_ivf(index) is not None
+        return index, index_file if mapped else None
+    
     def similarity_search(self, query_vector: np.ndarray, k: Optional[int] = None) -> List[Dict]:
         """
         相似度搜索
@@ -146,20 +414,32 @@ class FAISSVectorStore:
         if query_vector.ndim == 1:
             query_vector = query_vector.reshape(1, -1)
         
+        # 复制后再归一化为单位向量，使内积等价于余弦相似度，不修改调用方的数组
+        query_vector = np.array(query_vector, dtype=np.float32, order='C')
+        faiss.normalize_L2(query_vector)
+        
         # 搜索
-        distances, indices = self.index.search(
-            query_vector.astype(np.float32), k
-        )
+        distances, indices = self.index.search(query_vector, k)
+        
+        # 构建结果，一次性从列式表中取出所有命中行
+        hits = [
+            (rank, int(idx), float(distances[0][rank]))
+            for rank, idx in enumerate(indices[0])
+            if idx != -1 and idx < self.metadata.num_rows
+        ]
+        if not hits:
+            return []
+        
+        rows = self.metadata.take(pa.array([idx for _, idx, _ in hits])).to_pylist()
         
-        # 构建结果
         results = []
-        for i, idx in enumerate(indices[0]):
-            if idx != -1 and idx < len(self.metadata):
-                results.append({
-                    'metadata': self.metadata[idx],
-                    'score': float(distances[0][i]),
-                    'rank': i + 1
-                })
+        for (rank, _, score), row in zip(hits, rows):
+            results.append({
+                # 去掉该行不存在的字段（列式存储中为null）
+                'metadata': {key: value for key, value in row.items() if value is not None},
+                'score': score,
+                'rank': rank + 1
+            })
         
         return results
     
@@ -170,9 +450,10 @@ class FAISSVectorStore:
         
         return {
             'status': '已加载',
-            'total_vectors': self.index.ntotal if hasattr(self.index, 'ntotal') else len(self.metadata),
+            'total_vectors': self.index.ntotal if hasattr(self.index, 'ntotal') else self.metadata.num_rows,
             'dimension': self.index.d if hasattr(self.index, 'd') else '未知',
-            'metadata_count': len(self.metadata)
+            'metadata_count': self.metadata.num_rows,
+            'file_count': len(self.file_ranges)
         }
 
 
@@ -1,11 +1,18 @@
+import os
+import hashlib
+import sqlite3
 import numpy as np
 import torch
-from typing import List, Optional
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional
 from sentence_transformers import SentenceTransformer
-from tqdm import tqdm
 
 from utils.config import config
 
+# sqlite 单条语句的参数数量上限较小，分批查询
+_SQLITE_MAX_VARIABLES = 500
+
 class Vectorizer:
     """向量化器，负责文本到向量的转换"""
     
@@ -13,8 +20,38 @@ class Vectorizer:
         self.model_name = model_name or config.get('embedding.model_name', 'moka-ai/m3e-large')
         self.batch_size = config.get('embedding.batch_size', 32)
         self.normalize = config.get('embedding.normalize_embeddings', True)
+        self.use_cache = config.get('embedding.use_cache', True)
+        self.use_fp16 = config.get('embedding.fp16', True)
         self.model = None
+        self.device = None
         self.dimension = None
+        
+        # 两级嵌入缓存：有容量上限的内存LRU + sqlite文件，键为内容哈希
+        self.memory_cache_size = config.get('embedding.memory_cache_size', 10000)
+        self._memory_cache: OrderedDict = OrderedDict()
+        self._cache_db = None
+        if self.use_cache:
+            self._open_cache()
+        
+        self._cached_query = lru_cache(maxsize=2048)(self._encode_query)
+    
+    def _open_cache(self):
+        """打开磁盘嵌入缓存"""
+        cache_dir = config.get('system.model_cache_dir', './models')
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._cache_db = sqlite3.connect(
+                os.path.join(cache_dir, 'embeddings.sqlite'),
+                check_same_thread=False
+            )
+            self._cache_db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings "
+                "(hash BLOB PRIMARY KEY, dim INT, vec BLOB)"
+            )
+            self._cache_db.commit()
+        except sqlite3.Error as e:
+            print(f"嵌入缓存不可用，跳过磁盘缓存: {e}")
+            self._cache_db = None
     
     def initialize(self) -> bool:
         """初始化模型"""
@@ -30,6 +67,11 @@ class Vectorizer:
                 device=device,
                 cache_folder=cache_folder
             )
+            self.device = device
+            
+            # GPU上使用半精度推理
+            if device == 'cuda' and self.use_fp16:
+                self.model = self.model.half()
             
             # 获取模型维度
             test_embedding = self.model.encode(["测试文本"], normalize_embeddings=False)
@@ -42,16 +84,92 @@ class Vectorizer:
             print(f"模型加载失败: {e}")
             raise VectorizationError(f"初始化模型失败: {str(e)}")
     
+    def _cache_key(self, text: str) -> bytes:
+        """计算缓存键：模型名 + 归一化标志 + 推理精度 + 文本内容的哈希"""
+        precision = 'fp16' if self.device == 'cuda' and self.use_fp16 else 'fp32'
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{self.model_name}\x00{int(bool(self.normalize))}\x00{precision}\x00".encode('utf-8'))
+        h.update(text.encode('utf-8'))
+        return h.digest()
+    
+    def _lookup_cache(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """批量查询缓存，返回命中的向量"""
+        found = {}
+        pending = []
+        for key in keys:
+            vector = self._memory_cache.get(key)
+            if vector is not None:
+                self._memory_cache.move_to_end(key)
+                found[key] = vector
+            elif key not in found:
+                pending.append(key)
+        
+        if self._cache_db is None or not pending:
+            return found
+        
+        pending = list(dict.fromkeys(pending))
+        try:
+            for start in range(0, len(pending), _SQLITE_MAX_VARIABLES):
+                part = pending[start:start + _SQLITE_MAX_VARIABLES]
+                placeholders = ','.join('?' * len(part))
+                rows = self._cache_db.execute(
+                    f"SELECT hash, dim, vec FROM embeddings WHERE hash IN ({placeholders})",
+                    part
+                )
+                for key, dim, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    if vector.size != dim:
+                        continue
+                    key = bytes(key)
+                    found[key] = vector
+                    self._remember(key, vector)
+        except sqlite3.Error as e:
+            print(f"读取嵌入缓存失败: {e}")
+        
+        return found
+    
+    def _remember(self, key: bytes, vector: np.ndarray):
+        """写入内存缓存，超出容量时淘汰最久未使用的条目"""
+        if self.memory_cache_size <= 0:
+            return
+        # 复制单行，避免行视图让整批矩阵常驻内存
+        self._memory_cache[key] = vector.copy()
+        self._memory_cache.move_to_end(key)
+        while len(self._memory_cache) > self.memory_cache_size:
+            self._memory_cache.popitem(last=False)
+    
+    def _store_cache(self, keys: List[bytes], embeddings: np.ndarray):
+        """将新计算的向量写入缓存"""
+        embeddings = embeddings.astype(np.float32, copy=False)
+        for key, vector in zip(keys, embeddings):
+            self._remember(key, vector)
+        
+        if self._cache_db is None:
+            return
+        
+        rows = [
+            (key, int(vector.shape[0]), vector.tobytes())
+            for key, vector in zip(keys, embeddings)
+        ]
+        try:
+            with self._cache_db:
+                self._cache_db.executemany(
+                    "INSERT OR REPLACE INTO embeddings (hash, dim, vec) VALUES (?, ?, ?)",
+                    rows
+                )
+        except sqlite3.Error as e:
+            print(f"写入嵌入缓存失败: {e}")
+    
     def embed_texts(self, texts: List[str], show_progress: bool = True) -> np.ndarray:
         """
-        批量嵌入文本
+        批量嵌入文本，已缓存的文本不会重复编码
         
         Args:
             texts: 文本列表
             show_progress: 是否显示进度条
             
         Returns:
-            np.ndarray: 嵌入向量矩阵
+            np.ndarray: 嵌入向量矩阵（float32，C连续）
         """
         if not texts:
             return np.array([])
@@ -59,48 +177,68 @@ class Vectorizer:
         if self.model is None:
             self.initialize()
         
-        embeddings = []
+        if not self.use_cache:
+            return self._encode_texts(texts, show_progress)
         
-        # 分批处理
-        if show_progress:
-            iterator = tqdm(range(0, len(texts), self.batch_size), desc="向量化")
-        else:
-            iterator = range(0, len(texts), self.batch_size)
+        keys = [self._cache_key(text) for text in texts]
+        cached = self._lookup_cache(keys)
         
-        for i in iterator:
-            batch = texts[i:i + self.batch_size]
-            if not batch:
-                continue
-            
-            try:
-                batch_embeddings = self.model.encode(
-                    batch,
-                    batch_size=len(batch),
-                    show_progress_bar=False,
-                    normalize_embeddings=self.normalize,
-                    convert_to_numpy=True
-                )
-                embeddings.append(batch_embeddings)
-            except Exception as e:
-                raise VectorizationError(f"向量化批次 {i//self.batch_size} 失败: {str(e)}")
+        # 只编码未命中的文本（同一批次内的重复文本只编码一次）
+        misses = {}
+        for key, text in zip(keys, texts):
+            if key not in cached and key not in misses:
+                misses[key] = text
         
-        if embeddings:
-            return np.vstack(embeddings)
-        else:
-            return np.array([])
+        if misses:
+            miss_keys = list(misses)
+            new_embeddings = self._encode_texts([misses[key] for key in miss_keys], show_progress)
+            self._store_cache(miss_keys, new_embeddings)
+            cached.update(zip(miss_keys, new_embeddings))
+        
+        # 按原始顺序重组结果
+        embeddings = np.empty((len(texts), self.dimension), dtype=np.float32)
+        for i, key in enumerate(keys):
+            embeddings[i] = cached[key]
+        
+        return embeddings
+    
+    def _encode_texts(self, texts: List[str], show_progress: bool = True) -> np.ndarray:
+        """调用模型编码文本，由模型内部按长度排序分批"""
+        # GPU上结果保留为张量，全部完成后一次性拷回内存
+        on_gpu = self.device == 'cuda'
+        try:
+            embeddings = self.model.encode(
+                texts,
+                batch_size=self.batch_size,
+                show_progress_bar=show_progress,
+                normalize_embeddings=self.normalize,
+                convert_to_numpy=not on_gpu,
+                convert_to_tensor=on_gpu
+            )
+        except Exception as e:
+            raise VectorizationError(f"向量化失败: {str(e)}")
+        
+        if on_gpu:
+            return embeddings.float().cpu().numpy()
+        return embeddings.astype(np.float32, copy=False)
     
     def embed_query(self, query: str) -> np.ndarray:
-        """嵌入单个查询"""
+        """嵌入单个查询，相同查询直接命中缓存"""
         if self.model is None:
             self.initialize()
         
+        # 返回副本，避免调用方修改缓存中的向量
+        return self._cached_query(query).copy()
+    
+    def _encode_query(self, query: str) -> np.ndarray:
+        """编码单个查询"""
         embedding = self.model.encode(
             [query],
             normalize_embeddings=self.normalize,
             convert_to_numpy=True
         )
         
-        return embedding[0]
+        return embedding[0].astype(np.float32, copy=False)
     
     def get_dimension(self) -> int:
         """获取向量维度"""
@@ -7,6 +7,7 @@ class Config:
     
     _instance = None
     _config = None
+    _flat = None
     
     def __new__(cls):
         if cls._instance is None:
@@ -24,6 +25,8 @@ class Config:
             with open(config_path, 'r', encoding='utf-8') as f:
                 self._config = yaml.safe_load(f)
         
+        self._flatten()
+        
         # 创建必要的目录
         self._create_directories()
     
@@ -39,16 +42,26 @@ class Config:
             'text_splitter': {
                 'chunk_size': 800,
                 'chunk_overlap': 150,
-                'separators': ["\n\n", "\n", "。", "！", "？", "；", "，", " ", ""]
+                'separators': ["\n\n", "\n", "。", "！", "？", "；", "，", " ", ""],
+                'backend': 'rust'
             },
             'embedding': {
                 'model_name': 'moka-ai/m3e-large',
                 'batch_size': 32,
-                'normalize_embeddings': True
+                'normalize_embeddings': True,
+                'use_cache': True,
+                'memory_cache_size': 10000,
+                'fp16': True
             },
             'faiss': {
                 'use_gpu': True,
-                'search_k': 5
+                'search_k': 5,
+                'index_type': 'auto',
+                'quantizer': 'fp16',
+                'normalize': False,
+                'num_threads': 0,
+                'mmap': True,
+                'build_batch_size': 4096
             },
             'document': {
                 'supported_extensions': ['.pdf', '.txt', '.md', '.docx'],
@@ -67,17 +80,22 @@ class Config:
         for directory in dirs:
             os.makedirs(directory, exist_ok=True)
     
+    def _flatten(self):
+        """将嵌套配置展开为点分隔键的字典，加速查询"""
+        self._flat = {}
+        
+        def _walk(d, prefix=''):
+            for k, v in d.items():
+                key = f"{prefix}{k}"
+                self._flat[key] = v
+                if isinstance(v, dict):
+                    _walk(v, key + '.')
+        
+        _walk(self._config or {})
+    
     def get(self, key: str, default=None) -> Any:
         """获取配置值，支持点分隔符"""
-        keys = key.split('.')
-        value = self._config
-        
-        try:
-            for k in keys:
-                value = value[k]
-            return value
-        except (KeyError, TypeError):
-            return default
+        return self._flat.get(key, default)
     
     def update(self, key: str, value: Any):
         """更新配置值"""
@@ -92,11 +110,14 @@ class Config:
         
         # 设置最后一个key的值
         config[keys[-1]] = value
+        self._flatten()
     
     def save(self):
         """保存配置到文件"""
-        with open('config.yaml', 'w', encoding='utf-8') as f:
+        # 先写入临时文件再原子替换
+        with open('config.yaml.tmp', 'w', encoding='utf-8') as f:
             yaml.dump(self._config, f, default_flow_style=False, allow_unicode=True)
+        os.replace('config.yaml.tmp', 'config.yaml')
 
 # 全局配置实例
 config = Config()
\ No newline at end of file